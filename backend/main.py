@@ -188,7 +188,7 @@ def start_server(port: int = 8000, use_ngrok: bool = True, ngrok_token: str = No
 
 if __name__ == "__main__":
     # Configuration
-    NGROK_TOKEN = "348roSQj2iERV8fMgVaCYElBgfB_4yPs4jKrwU4U323bzpmJL"
+    NGROK_TOKEN = os.getenv("NGROK_TOKEN")
     PORT = 8000
     USE_NGROK = True  # Set to False for local testing
     
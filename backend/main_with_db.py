@@ -4,18 +4,49 @@ FastAPI server with ngrok tunneling for Kaggle hosting
 """
 import os
 import sys
-import shutil
-import json
+import atexit
+import logging
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
+import aiofiles
+import numpy as np
+import orjson
 import uvicorn
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pyngrok import ngrok
-from pipeline import TaxonomyPipeline
+from pipeline import TaxonomyPipeline, init_worker, warm_worker, process_file_in_worker, process_bytes_in_worker
+from temp_file_pool import TempFilePool
+
+# Supabase client errors (postgrest and httpx ship with supabase, which is optional here)
+try:
+    import httpx
+    from postgrest.exceptions import APIError
+except ImportError:
+    APIError = None
+
+# Optional: brotli compresses result JSON better than gzip at similar CPU
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+# Per-request logging goes through `logger.debug`, which is skipped at the
+# default INFO level (set LOG_LEVEL=DEBUG to trace uploads)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(levelname)s %(name)s: %(message)s")
+# httpx logs every request at INFO - keep per-request lines off the hot path
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # Add parent directory to path for db imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db.request_params import job_id_list
 
 # Initialize database (optional - backend works without it)
 try:
@@ -27,11 +58,36 @@ except Exception as e:
     print("⚠️ Backend will work without database (no data persistence)")
     db = None
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start analysis workers before the first upload and stop them on shutdown"""
+    global executor
+    # Fork-based workers inherit the parent's loaded pipeline copy-on-write instead
+    # of rebuilding it; elsewhere (spawn) each worker loads its own, since pickling
+    # it to every worker costs more
+    pipeline = TaxonomyPipeline() if _POOL_CONTEXT is not None else None
+    executor = ProcessPoolExecutor(
+        max_workers=ANALYSIS_WORKERS,
+        mp_context=_POOL_CONTEXT,
+        initializer=init_worker,
+        initargs=(pipeline,)
+    )
+    
+    loop = asyncio.get_running_loop()
+    # One task per worker - spawn-based pools only start workers as tasks queue up
+    await asyncio.gather(*(loop.run_in_executor(executor, warm_worker) for _ in range(ANALYSIS_WORKERS)))
+    print(f"✅ Analysis pool ready ({ANALYSIS_WORKERS} workers)")
+    yield
+    executor.shutdown(wait=False, cancel_futures=True)
+    temp_file_pool.close()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Taxaformer API",
     description="Taxonomic analysis pipeline for DNA sequences",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -43,13 +99,114 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize pipeline
-pipeline = TaxonomyPipeline()
+# Compress large JSON bodies (brotli when installed, gzip otherwise)
+COMPRESS_MIN_SIZE = 1024
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, quality=4, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=5)
+
+
+# Errors escaping an endpoint: failed or unreachable Supabase queries are
+# upstream (502), anything else is a 500
+if APIError is not None:
+    @app.exception_handler(APIError)
+    async def supabase_error_handler(request: Request, exc: APIError):
+        """Report a failed PostgREST query as a bad gateway"""
+        logger.warning("Supabase error on %s: %s", request.url.path, exc.message)
+        return ORJSONResponse({"detail": exc.message}, status_code=502)
+    
+    @app.exception_handler(httpx.TransportError)
+    async def supabase_unreachable_handler(request: Request, exc: httpx.TransportError):
+        """Report a PostgREST request that never got a response as a bad gateway"""
+        logger.warning("Supabase unreachable on %s: %r", request.url.path, exc)
+        return ORJSONResponse({"detail": "Database request failed"}, status_code=502)
+
+
+@app.exception_handler(Exception)
+async def unhandled_error_handler(request: Request, exc: Exception):
+    """
+    Generic fallback - don't leak internals in the response
+    
+    Starlette runs this handler outside CORSMiddleware, so the CORS headers
+    are added here or browsers would hide the 500 from the frontend.
+    """
+    logger.error("Unhandled error on %s %s: %r", request.method, request.url.path, exc)
+    origin = request.headers.get("origin")
+    headers = {"Access-Control-Allow-Origin": origin, "Access-Control-Allow-Credentials": "true",
+               "Vary": "Origin"} if origin else {}
+    return ORJSONResponse({"detail": "Internal server error"}, status_code=500, headers=headers)
+
+
+# Analysis runs in a process pool so CPU-bound inference isn't serialized by the GIL.
+# By default one server process owns a pool with a worker per core. Each extra
+# server worker (WEB_CONCURRENCY) loads its own pipeline and pool, splitting the
+# cores between them - memory grows N-fold for no extra analysis throughput.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+_POOL_CONTEXT = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+# Created by lifespan, so the pipeline is only loaded in serving processes
+# (not in the uvicorn launcher or on import)
+executor: Optional[ProcessPoolExecutor] = None
 
 # Directory for temporary files
 TEMP_DIR = "temp_uploads"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Reusable temp files for large uploads (sized to expected concurrency)
+temp_file_pool = TempFilePool(TEMP_DIR, size=int(os.getenv("TEMP_FILE_POOL_SIZE", "32")))
+atexit.register(temp_file_pool.close)
+
+# Upload chunk size when streaming to disk (1 MiB)
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Uploads smaller than this are processed in memory (32 MiB)
+INMEMORY_UPLOAD_LIMIT = int(os.getenv("INMEMORY_UPLOAD_LIMIT", 32 << 20))
+
+# Records per orjson.dumps call and bytes per chunk when streaming JSON
+STREAM_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 64 << 10
+
+
+def _iter_json(value):
+    """
+    Encode value as JSON piece by piece
+    
+    Lists are encoded in batches of STREAM_BATCH_SIZE records, and
+    matrices (lists of rows) row by row, so large results are never
+    materialized as a single bytes object.
+    """
+    if isinstance(value, dict):
+        yield b"{"
+        for i, (key, item) in enumerate(value.items()):
+            yield (b"," if i else b"") + orjson.dumps(str(key)) + b":"
+            yield from _iter_json(item)
+        yield b"}"
+    elif isinstance(value, (list, np.ndarray)) and len(value) > 0:
+        batch_size = 1 if isinstance(value[0], (list, np.ndarray)) else STREAM_BATCH_SIZE
+        yield b"["
+        for start in range(0, len(value), batch_size):
+            encoded = orjson.dumps(value[start:start + batch_size], option=orjson.OPT_SERIALIZE_NUMPY)
+            yield (b"," if start else b"") + encoded[1:-1]
+        yield b"]"
+    else:
+        yield orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def stream_json(value) -> StreamingResponse:
+    """Stream value as a JSON response in STREAM_CHUNK_SIZE chunks"""
+    def chunks():
+        buffer = bytearray()
+        for piece in _iter_json(value):
+            buffer += piece
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+    
+    return StreamingResponse(chunks(), media_type="application/json")
+
 
 @app.get("/")
 async def root():
@@ -78,6 +235,7 @@ async def analyze_endpoint(
     Returns:
         JSON with analysis results and job_id (if database enabled)
     """
+    temp_fd = None
     temp_filepath = None
     parsed_metadata = None
     
@@ -85,10 +243,10 @@ async def analyze_endpoint(
         # Parse metadata if provided
         if metadata:
             try:
-                parsed_metadata = json.loads(metadata)
-                print(f"📋 Received metadata: {parsed_metadata}")
-            except json.JSONDecodeError as e:
-                print(f"⚠️ Warning: Could not parse metadata: {e}")
+                parsed_metadata = orjson.loads(metadata)
+                logger.debug("Received metadata: %s", parsed_metadata)
+            except orjson.JSONDecodeError as e:
+                logger.warning("Could not parse metadata: %s", e)
         
         # Validate file
         if not file.filename:
@@ -103,17 +261,35 @@ async def analyze_endpoint(
                 detail=f"Unsupported file type. Allowed: {', '.join(allowed_extensions)}"
             )
         
-        # Save uploaded file temporarily
-        temp_filepath = os.path.join(TEMP_DIR, f"temp_{datetime.now().timestamp()}_{file.filename}")
-        
-        with open(temp_filepath, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        loop = asyncio.get_running_loop()
         
-        print(f"Processing file: {file.filename} ({os.path.getsize(temp_filepath)} bytes)")
+        if file.size is not None and file.size < INMEMORY_UPLOAD_LIMIT:
+            # Small uploads are analyzed straight from memory - no temp file round-trip
+            file_bytes = await file.read()
+            logger.debug("Processing file: %s (%d bytes, in memory)", file.filename, len(file_bytes))
+            
+            start_time = datetime.now()
+            result_data = await loop.run_in_executor(
+                executor, process_bytes_in_worker, file_bytes, file.filename
+            )
+        else:
+            # Save uploaded file temporarily (pooled file, reused across requests)
+            temp_fd, temp_filepath = temp_file_pool.acquire()
+            
+            # Stream to disk in chunks so the event loop isn't blocked by large uploads
+            async with aiofiles.open(temp_fd, "wb", closefd=False) as buffer:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    await buffer.write(chunk)
+            
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Processing file: %s (%d bytes)", file.filename, os.fstat(temp_fd).st_size)
+            
+            # Process file through pipeline (in the analysis process pool)
+            start_time = datetime.now()
+            result_data = await loop.run_in_executor(
+                executor, process_file_in_worker, temp_filepath, file.filename
+            )
         
-        # Process file through pipeline
-        start_time = datetime.now()
-        result_data = pipeline.process_file(temp_filepath, file.filename)
         processing_time = (datetime.now() - start_time).total_seconds()
         
         # Add processing time and metadata to result
@@ -127,7 +303,7 @@ async def analyze_endpoint(
                 "userMetadata": parsed_metadata
             }
         
-        print(f"Analysis complete: {file.filename} ({processing_time:.2f}s)")
+        logger.debug("Analysis complete: %s (%.2fs)", file.filename, processing_time)
         
         # Store in database if available
         job_id = None
@@ -138,9 +314,9 @@ async def analyze_endpoint(
                     metadata=parsed_metadata,
                     analysis_result=result_data
                 )
-                print(f"💾 Saved to database with job_id: {job_id}")
+                logger.debug("Saved to database with job_id: %s", job_id)
             except Exception as db_error:
-                print(f"⚠️ Database save failed: {db_error}")
+                logger.warning("Database save failed: %s", db_error)
                 # Continue without database - analysis still succeeds
         
         # Return response
@@ -152,15 +328,15 @@ async def analyze_endpoint(
         if job_id:
             response["job_id"] = job_id
         
-        return response
+        # Stream the (potentially large) result instead of encoding it in one go
+        return stream_json(response)
         
     except HTTPException:
         raise
         
     except Exception as e:
-        print(f"Error processing file: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        # Full traceback only when debugging
+        logger.error("Error processing file: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
         
         return {
             "status": "error",
@@ -168,12 +344,9 @@ async def analyze_endpoint(
         }
         
     finally:
-        # Clean up temporary file
-        if temp_filepath and os.path.exists(temp_filepath):
-            try:
-                os.remove(temp_filepath)
-            except Exception as e:
-                print(f"Warning: Could not delete temp file: {e}")
+        # Return temporary file to the pool
+        if temp_fd is not None:
+            temp_file_pool.release(temp_fd, temp_filepath)
 
 
 @app.get("/health")
@@ -198,10 +371,7 @@ async def get_composition(job_id: str, rank: str = "phylum"):
     if db is None:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        return db.get_taxonomic_composition(job_id, rank)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return ORJSONResponse(db.get_taxonomic_composition(job_id, rank))
 
 
 @app.get("/visualizations/hierarchy/{job_id}")
@@ -210,10 +380,7 @@ async def get_hierarchy(job_id: str):
     if db is None:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        return db.get_hierarchical_data(job_id)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return ORJSONResponse(db.get_hierarchical_data(job_id))
 
 
 @app.get("/visualizations/sankey/{job_id}")
@@ -222,36 +389,25 @@ async def get_sankey(job_id: str):
     if db is None:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        return db.get_sankey_data(job_id)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return ORJSONResponse(db.get_sankey_data(job_id))
 
 
 @app.get("/visualizations/heatmap")
-async def get_heatmap(job_ids: str, rank: str = "class"):
-    """Get heatmap data for multiple samples"""
+async def get_heatmap(job_ids: List[str] = Depends(job_id_list), rank: str = "class"):
+    """Get heatmap data for multiple samples (at most MAX_JOB_IDS)"""
     if db is None:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        ids = job_ids.split(",")
-        return db.get_heatmap_data(ids, rank)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return stream_json(db.get_heatmap_data(job_ids, rank))
 
 
 @app.get("/visualizations/diversity")
-async def get_diversity(job_ids: str):
-    """Calculate beta diversity between samples"""
+async def get_diversity(job_ids: List[str] = Depends(job_id_list)):
+    """Calculate beta diversity between samples (at most MAX_JOB_IDS)"""
     if db is None:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        ids = job_ids.split(",")
-        return db.calculate_beta_diversity(ids)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return stream_json(db.calculate_beta_diversity(job_ids))
 
 
 # ================================
@@ -264,10 +420,7 @@ async def list_jobs(limit: int = 50):
     if db is None:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        return db.get_all_jobs(limit)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return db.get_all_jobs(limit)
 
 
 @app.get("/jobs/{job_id}")
@@ -276,22 +429,18 @@ async def get_job(job_id: str):
     if db is None:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        job = db.get_job_by_id(job_id)
-        if job is None:
-            raise HTTPException(status_code=404, detail="Job not found")
-        return job
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    job = db.get_job_by_id(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 # ================================
 # SERVER STARTUP
 # ================================
 
-def start_server(port: int = 8000, use_ngrok: bool = True, ngrok_token: str = None):
+def start_server(port: int = 8000, use_ngrok: bool = True, ngrok_token: str = None,
+                 workers: Optional[int] = None):
     """
     Start the FastAPI server with optional ngrok tunneling
     
@@ -299,7 +448,15 @@ def start_server(port: int = 8000, use_ngrok: bool = True, ngrok_token: str = No
         port: Port to run the server on
         use_ngrok: Whether to create ngrok tunnel
         ngrok_token: Ngrok authentication token
+        workers: Number of server worker processes (defaults to WEB_CONCURRENCY or 1).
+            Each one loads its own pipeline, so more than one multiplies memory.
     """
+    if workers is None:
+        workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    
+    # Worker processes read this to size their analysis pools
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    
     if use_ngrok:
         if not ngrok_token:
             raise ValueError("ngrok_token is required when use_ngrok=True")
@@ -343,15 +500,24 @@ def start_server(port: int = 8000, use_ngrok: bool = True, ngrok_token: str = No
         print(f"💾 DATABASE: {'Connected' if db else 'Disabled'}")
         print("⚠️  No ngrok tunnel - local access only\n")
     
-    # Run server
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Run server - multiple workers need the app as an import string; a single
+    # one serves this module's app instead of importing (and connecting) again
+    uvicorn.run(
+        app if workers == 1 else "main_with_db:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )
 
 
 if __name__ == "__main__":
     # Configuration
-    NGROK_TOKEN = "348roSQj2iERV8fMgVaCYElBgfB_4yPs4jKrwU4U323bzpmJL"
-    PORT = 8000
-    USE_NGROK = True  # Set to False for local testing
+    NGROK_TOKEN = os.getenv("NGROK_TOKEN")
+    PORT = int(os.getenv("PORT", "8000"))
+    USE_NGROK = os.getenv("USE_NGROK", "true").lower() == "true"  # Set USE_NGROK=false for local testing
     
     # Start server
     start_server(port=PORT, use_ngrok=USE_NGROK, ngrok_token=NGROK_TOKEN)
@@ -3,12 +3,46 @@ Taxonomy Analysis Pipeline
 Processes sequence files and generates analysis results
 """
 import os
+import io
+import functools
 import json
 import random
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Tuple, Optional
 from collections import Counter
 import numpy as np
 
+# Per-process pipeline used by analysis pool workers (see init_worker)
+_worker_pipeline = None
+
+
+# (keywords, group) checked in order against each taxonomy level
+_MAIN_GROUPS = (
+    (('Metazoa', 'Animalia'), "Metazoa"),
+    (('Alveolata', 'Dinoflagellata'), "Alveolata"),
+    (('Chlorophyta',), "Chlorophyta"),
+    (('Fungi',), "Fungi"),
+    (('Rhodophyta',), "Rhodophyta"),
+    (('Stramenopiles',), "Stramenopiles"),
+    (('Bacteria',), "Bacteria"),
+    (('Archaea',), "Archaea"),
+    (('Cryptophyta',), "Cryptophyta"),
+)
+
+
+@functools.lru_cache(maxsize=1 << 14)
+def _main_group(taxonomy: str) -> str:
+    """
+    Identify the main taxonomic group of a taxonomy string
+    
+    The first level matching any group's keywords decides the group.
+    """
+    for part in taxonomy.split(';'):
+        part = part.strip()
+        for keywords, group in _MAIN_GROUPS:
+            if any(keyword in part for keyword in keywords):
+                return group
+    return "Unknown"
+
 
 class TaxonomyPipeline:
     """Pipeline for processing taxonomic sequence data"""
@@ -45,7 +79,42 @@ class TaxonomyPipeline:
         try:
             # Read and parse sequences
             sequences = self._parse_fasta(filepath)
+        except Exception as e:
+            raise Exception(f"Pipeline processing failed: {str(e)}")
+        
+        return self._process_sequences(sequences, filename)
+    
+    def process_bytes(self, data: bytes, filename: str) -> Dict[str, Any]:
+        """
+        Analyze sequence file content that is already in memory
+        
+        Args:
+            data: Raw uploaded file content
+            filename: Original filename
+            
+        Returns:
+            Dictionary with analysis results in frontend format
+        """
+        try:
+            with io.TextIOWrapper(io.BytesIO(data)) as f:
+                sequences = self._parse_lines(f)
+        except Exception as e:
+            raise Exception(f"Pipeline processing failed: Failed to parse file: {str(e)}")
+        
+        return self._process_sequences(sequences, filename)
+    
+    def _process_sequences(self, sequences: List[Dict[str, str]], filename: str) -> Dict[str, Any]:
+        """
+        Analyze parsed sequences and build the response
+        
+        Args:
+            sequences: List of parsed sequences
+            filename: Original filename
             
+        Returns:
+            Dictionary with analysis results in frontend format
+        """
+        try:
             if not sequences:
                 raise ValueError("No valid sequences found in file")
             
@@ -81,6 +150,22 @@ class TaxonomyPipeline:
         Args:
             filepath: Path to sequence file
             
+        Returns:
+            List of sequence dictionaries
+        """
+        try:
+            with open(filepath, 'r') as f:
+                return self._parse_lines(f)
+        except Exception as e:
+            raise Exception(f"Failed to parse file: {str(e)}")
+    
+    def _parse_lines(self, lines) -> List[Dict[str, str]]:
+        """
+        Parse FASTA/FASTQ content from an iterable of lines
+        
+        Args:
+            lines: File object or other iterable of text lines
+            
         Returns:
             List of sequence dictionaries
         """
@@ -88,54 +173,49 @@ class TaxonomyPipeline:
         current_seq = None
         current_id = None
         
-        try:
-            with open(filepath, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    
-                    if not line:
-                        continue
-                    
-                    # FASTA header
-                    if line.startswith('>'):
-                        # Save previous sequence
-                        if current_id and current_seq:
-                            sequences.append({
-                                'id': current_id,
-                                'sequence': current_seq
-                            })
-                        
-                        # Start new sequence
-                        current_id = line[1:].split()[0]  # Get first part of header
-                        current_seq = ""
-                    
-                    # FASTQ header
-                    elif line.startswith('@'):
-                        if current_id and current_seq:
-                            sequences.append({
-                                'id': current_id,
-                                'sequence': current_seq
-                            })
-                        current_id = line[1:].split()[0]
-                        current_seq = ""
-                    
-                    # Sequence data
-                    elif current_id and not line.startswith('+'):
-                        # Skip quality scores in FASTQ
-                        if all(c in 'ACGTNacgtn' for c in line):
-                            current_seq += line
-                
-                # Add last sequence
+        for line in lines:
+            line = line.strip()
+            
+            if not line:
+                continue
+            
+            # FASTA header
+            if line.startswith('>'):
+                # Save previous sequence
                 if current_id and current_seq:
                     sequences.append({
                         'id': current_id,
                         'sequence': current_seq
                     })
+                
+                # Start new sequence
+                current_id = line[1:].split()[0]  # Get first part of header
+                current_seq = ""
             
-            return sequences
+            # FASTQ header
+            elif line.startswith('@'):
+                if current_id and current_seq:
+                    sequences.append({
+                        'id': current_id,
+                        'sequence': current_seq
+                    })
+                current_id = line[1:].split()[0]
+                current_seq = ""
             
-        except Exception as e:
-            raise Exception(f"Failed to parse file: {str(e)}")
+            # Sequence data
+            elif current_id and not line.startswith('+'):
+                # Skip quality scores in FASTQ
+                if all(c in 'ACGTNacgtn' for c in line):
+                    current_seq += line
+        
+        # Add last sequence
+        if current_id and current_seq:
+            sequences.append({
+                'id': current_id,
+                'sequence': current_seq
+            })
+        
+        return sequences
     
     def _analyze_sequences(self, sequences: List[Dict[str, str]]) -> List[Dict[str, Any]]:
         """
@@ -209,52 +289,15 @@ class TaxonomyPipeline:
         Returns:
             List of taxonomy group counts
         """
-        # Count by main taxonomic group
-        group_counts = Counter()
+        # Count each distinct (taxonomy, novel) pair in C, then classify each
+        # distinct taxonomy once instead of once per sequence
+        pair_counts = Counter(
+            (seq['taxonomy'], seq.get('status') == 'POTENTIALLY NOVEL') for seq in sequences
+        )
         
-        for seq in sequences:
-            taxonomy = seq['taxonomy']
-            
-            # Extract higher-level group
-            parts = taxonomy.split(';')
-            
-            # Try to identify main group
-            main_group = "Unknown"
-            for part in parts:
-                part = part.strip()
-                if any(keyword in part for keyword in ['Metazoa', 'Animalia']):
-                    main_group = "Metazoa"
-                    break
-                elif 'Alveolata' in part or 'Dinoflagellata' in part:
-                    main_group = "Alveolata"
-                    break
-                elif 'Chlorophyta' in part:
-                    main_group = "Chlorophyta"
-                    break
-                elif 'Fungi' in part:
-                    main_group = "Fungi"
-                    break
-                elif 'Rhodophyta' in part:
-                    main_group = "Rhodophyta"
-                    break
-                elif 'Stramenopiles' in part:
-                    main_group = "Stramenopiles"
-                    break
-                elif 'Bacteria' in part:
-                    main_group = "Bacteria"
-                    break
-                elif 'Archaea' in part:
-                    main_group = "Archaea"
-                    break
-                elif 'Cryptophyta' in part:
-                    main_group = "Cryptophyta"
-                    break
-            
-            # Check for novel
-            if seq.get('status') == 'POTENTIALLY NOVEL':
-                main_group = "Novel"
-            
-            group_counts[main_group] += 1
+        group_counts = Counter()
+        for (taxonomy, novel), count in pair_counts.items():
+            group_counts["Novel" if novel else _main_group(taxonomy)] += count
         
         # Convert to frontend format
         summary = []
@@ -339,3 +382,57 @@ class TaxonomyPipeline:
         }
         
         return metadata
+
+
+def init_worker(shared: Optional["TaxonomyPipeline"] = None):
+    """
+    Process pool initializer - sets up the pipeline once per worker process
+    so model state isn't reloaded for every request
+    
+    Args:
+        shared: Pipeline already loaded in the parent. With fork-based pools
+            this is inherited copy-on-write instead of being rebuilt.
+    """
+    global _worker_pipeline
+    if _worker_pipeline is None:
+        _worker_pipeline = shared if shared is not None else TaxonomyPipeline()
+
+
+def warm_worker() -> bool:
+    """
+    No-op task used to start pool workers ahead of the first request
+    
+    Returns:
+        True once the worker's pipeline is ready
+    """
+    return _worker_pipeline is not None
+
+
+def process_file_in_worker(filepath: str, filename: str) -> Dict[str, Any]:
+    """
+    Run TaxonomyPipeline.process_file inside an analysis pool worker
+    
+    Args:
+        filepath: Path to uploaded file
+        filename: Original filename
+        
+    Returns:
+        Dictionary with analysis results in frontend format
+    """
+    init_worker()
+    return _worker_pipeline.process_file(filepath, filename)
+
+
+def process_bytes_in_worker(data: bytes, filename: str) -> Dict[str, Any]:
+    """
+    Run TaxonomyPipeline.process_bytes inside an analysis pool worker
+    
+    Args:
+        data: Raw uploaded file content
+        filename: Original filename
+        
+    Returns:
+        Dictionary with analysis results in frontend format
+    """
+    init_worker()
+    return _worker_pipeline.process_bytes(data, filename)
@@ -0,0 +1,73 @@
+"""
+Temp File Pool for TaxaFormer
+Reuses upload temp files instead of creating and unlinking one per request
+"""
+import os
+import tempfile
+import threading
+from collections import deque
+from typing import Deque, Tuple
+
+
+class TempFilePool:
+    """
+    Bounded pool of open temporary files
+    Files are created with mkstemp (no name collisions, no user-controlled
+    paths) and truncated for reuse when released
+    """
+    
+    def __init__(self, directory: str, size: int = 32, suffix: str = ".upload"):
+        self.directory = directory
+        self.size = size
+        self.suffix = suffix
+        self._free: Deque[Tuple[int, str]] = deque()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def acquire(self) -> Tuple[int, str]:
+        """
+        Get an empty temp file
+        
+        Returns:
+            (fd, path) positioned at the start of an empty file
+        """
+        with self._lock:
+            if self._free:
+                return self._free.popleft()
+        
+        return tempfile.mkstemp(dir=self.directory, suffix=self.suffix)
+    
+    def release(self, fd: int, path: str):
+        """Return a temp file to the pool, or delete it if the pool is full"""
+        try:
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+        except OSError:
+            self._discard(fd, path)
+            return
+        
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append((fd, path))
+                return
+        
+        self._discard(fd, path)
+    
+    def close(self):
+        """Delete all pooled files"""
+        with self._lock:
+            files = list(self._free)
+            self._free.clear()
+        
+        for fd, path in files:
+            self._discard(fd, path)
+    
+    def _discard(self, fd: int, path: str):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Warning: Could not delete temp file: {e}")
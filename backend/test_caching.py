@@ -4,15 +4,21 @@ Run with: python -m pytest test_caching.py -v
 """
 import os
 import sys
+import asyncio
+import httpx
+import numpy as np
 import pytest
 import hashlib
 import json
-from unittest.mock import Mock, patch
+import uuid
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from db import supabase_db
 from db.supabase_db import TaxaformerDB
+from db.job_loader import JobLoader
 
 
 class TestFileCaching:
@@ -110,6 +116,730 @@ class TestDatabaseOperations:
         assert job is None
 
 
+class TestAnalysisCache:
+    """Test the cache-aside analysis fetch used by visualization endpoints"""
+    
+    @pytest.fixture
+    def mock_db(self):
+        """Create mock database without Redis"""
+        with patch.dict(os.environ, {
+            'SUPABASE_URL': 'https://test.supabase.co',
+            'SUPABASE_KEY': 'test-key'
+        }):
+            os.environ.pop('REDIS_URL', None)
+            with patch('db.supabase_db.create_client') as mock_client:
+                mock_client.return_value = Mock()
+                db = TaxaformerDB()
+                db.client = Mock()
+                # No precomputed taxon_counts unless a test provides them
+                db.client.table.return_value.select.return_value.eq.return_value.eq.return_value \
+                    .order.return_value.order.return_value.execute.return_value.data = []
+                # ...or precomputed chart payloads (the viz query shares the analysis mock chain)
+                db._fetch_viz = Mock(return_value=None)
+                return db
+    
+    def _mock_analysis(self, mock_db, job_id, taxonomies, sample_name=None):
+        query = mock_db.client.table.return_value.select.return_value.eq.return_value.limit.return_value
+        query.execute.return_value.data = [
+            {'job_id': job_id, 'sample_name': sample_name, 'taxonomies': taxonomies}
+        ]
+        return query
+    
+    def test_repeat_fetch_hits_cache(self, mock_db):
+        """Several endpoints for one job should cost one Supabase call"""
+        query = self._mock_analysis(mock_db, 'job-1', ["Eukaryota;Alveolata;Dinoflagellata"])
+        
+        mock_db.get_taxonomic_composition('job-1')
+        mock_db.get_hierarchical_data('job-1')
+        mock_db.get_sankey_data('job-1')
+        
+        assert query.execute.call_count == 1
+    
+    def test_composition_uses_requested_rank(self, mock_db):
+        """Composition should aggregate at the requested rank"""
+        self._mock_analysis(mock_db, 'job-r', [
+                "Eukaryota; Alveolata; Dinoflagellata",
+                "Eukaryota; Alveolata; Ciliophora",
+                "Eukaryota; Alveolata; Dinoflagellata",
+                "Bacteria"
+        ])
+        
+        composition = mock_db.get_taxonomic_composition('job-r', rank="class")
+        
+        assert [(c["name"], c["value"]) for c in composition["composition"]] == [
+            ("Dinoflagellata", 2),
+            ("Ciliophora", 1),
+            ("Unknown", 1)
+        ]
+        assert all(c["color"].startswith("#") for c in composition["composition"])
+    
+    def test_composition_reads_precomputed_counts(self, mock_db):
+        """Precomputed taxon_counts rows should skip the sequence fetch"""
+        counts = mock_db.client.table.return_value.select.return_value.eq.return_value.eq.return_value \
+            .order.return_value.order.return_value
+        counts.execute.return_value.data = [
+            {'taxon': 'Alveolata', 'count': 3},
+            {'taxon': 'Chlorophyta', 'count': 1}
+        ]
+        analysis = self._mock_analysis(mock_db, 'job-p', [])
+        
+        composition = mock_db.get_taxonomic_composition('job-p')
+        
+        assert [(c["name"], c["value"]) for c in composition["composition"]] == [
+            ("Alveolata", 3),
+            ("Chlorophyta", 1)
+        ]
+        assert composition["total"] == 4
+        assert analysis.execute.call_count == 0
+    
+    def test_composition_reuses_cached_taxonomies(self, mock_db):
+        """Composition after another chart should not query taxon_counts"""
+        self._mock_analysis(mock_db, 'job-h', ["Eukaryota;Alveolata", "Eukaryota;Alveolata"])
+        counts = mock_db.client.table.return_value.select.return_value.eq.return_value.eq.return_value \
+            .order.return_value.order.return_value
+        
+        mock_db.get_hierarchical_data('job-h')
+        composition = mock_db.get_taxonomic_composition('job-h')
+        
+        assert [(c["name"], c["value"]) for c in composition["composition"]] == [("Alveolata", 2)]
+        assert counts.execute.call_count == 0
+    
+    def test_charts_memoized_until_invalidated(self, mock_db):
+        """Repeat chart requests should reuse the result until the job is invalidated"""
+        self._mock_analysis(mock_db, 'job-m', ["Eukaryota;Alveolata"])
+        
+        build = Mock(wraps=supabase_db._build_hierarchy)
+        with patch.dict(supabase_db._CHART_BUILDERS, hierarchy=(build, {"hierarchy": []})):
+            first = mock_db.get_hierarchical_data('job-m')
+            assert mock_db.get_hierarchical_data('job-m') is first
+            assert build.call_count == 1
+            
+            mock_db.invalidate_job('job-m')
+            self._mock_analysis(mock_db, 'job-m', ["Eukaryota;Alveolata"])
+            mock_db.get_hierarchical_data('job-m')
+            assert build.call_count == 2
+    
+    def test_precomputed_chart_passed_through(self, mock_db):
+        """Precomputed chart JSON should be returned as stored, without a taxonomy fetch"""
+        stored = '{"hierarchy": [{"name": "Eukaryota", "value": 3, "children": []}]}'
+        requests = []
+        
+        def handler(request):
+            requests.append(request.url.path)
+            assert request.url.params['select'] == 'viz_hierarchy::text'
+            return httpx.Response(200, json=[{'viz_hierarchy': stored}])
+        
+        mock_db._http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://test")
+        
+        body = asyncio.run(mock_db.get_chart_json_async('job-v', "hierarchy"))
+        
+        assert body == stored.encode()
+        assert requests == ['/analysis_jobs']
+        
+        # Memoized after the first read
+        asyncio.run(mock_db.get_chart_json_async('job-v', "hierarchy"))
+        assert len(requests) == 1
+    
+    def test_sankey_counts_repeated_flows(self, mock_db):
+        """Sankey links should sum flows across repeated taxonomies"""
+        self._mock_analysis(mock_db, 'job-s', [
+                "Eukaryota; Alveolata; Dinoflagellata",
+                "Eukaryota; Alveolata; Dinoflagellata",
+                "Eukaryota; Chlorophyta",
+                "Bacteria"
+        ])
+        
+        sankey = mock_db.get_sankey_data('job-s')
+        links = {(link["source"], link["target"]): link["value"] for link in sankey["links"]}
+        
+        assert links == {
+            ("Eukaryota", "Alveolata"): 2,
+            ("Alveolata", "Dinoflagellata"): 2,
+            ("Eukaryota", "Chlorophyta"): 1
+        }
+        assert len(sankey["nodes"]) == 4
+    
+    def test_missing_job_not_cached(self, mock_db):
+        """Misses should be retried once the job exists"""
+        query = mock_db.client.table.return_value.select.return_value.eq.return_value.limit.return_value
+        query.execute.return_value.data = []
+        
+        assert mock_db._fetch_analysis('job-2') is None
+        assert mock_db._fetch_analysis('job-2') is None
+        assert query.execute.call_count == 2
+
+    def test_cached_analysis_expires(self, mock_db):
+        """In-process copies should expire so other workers' invalidations take effect"""
+        query = mock_db.client.table.return_value.select.return_value.eq.return_value.limit.return_value
+        query.execute.side_effect = lambda: Mock(data=[
+            {'job_id': 'job-t', 'sample_name': None, 'taxonomies': ["Eukaryota"]}
+        ])
+        
+        with patch('db.supabase_db.time.monotonic', return_value=1000.0):
+            mock_db._fetch_analysis('job-t')
+            mock_db._fetch_analysis('job-t')
+        assert query.execute.call_count == 1
+        
+        with patch('db.supabase_db.time.monotonic', return_value=1001.0 + supabase_db.ANALYSIS_CACHE_TTL):
+            mock_db._fetch_analysis('job-t')
+        assert query.execute.call_count == 2
+    
+    def test_store_invalidates_cache(self, mock_db):
+        """Storing a job drops any cached copy"""
+        self._mock_analysis(mock_db, 'job-3', [])
+        mock_db._fetch_analysis('job-3')
+        
+        mock_db.client.table.return_value.insert.return_value.execute.return_value.data = [
+            {'job_id': 'job-3'}
+        ]
+        mock_db.store_analysis("hash", "test.fasta", {"metadata": {}})
+        
+        assert mock_db._analysis_cache.get('job-3') is None
+    
+    def test_store_precomputes_charts(self, mock_db):
+        """Storing a job should write its hierarchy and Sankey payloads"""
+        mock_db.client.table.return_value.insert.return_value.execute.return_value.data = [
+            {'job_id': 'job-4'}
+        ]
+        mock_db.store_analysis("hash", "test.fasta", {
+            "sequences": [{"taxonomy": "Eukaryota;Alveolata"}, {"taxonomy": "Eukaryota;Alveolata"}]
+        })
+        
+        viz = mock_db.client.table.return_value.update.call_args[0][0]
+        assert viz["viz_hierarchy"]["hierarchy"][0] == {
+            "name": "Eukaryota", "value": 2,
+            "children": [{"name": "Alveolata", "value": 2, "children": []}]
+        }
+        assert viz["viz_sankey"]["links"] == [{"source": "Eukaryota", "target": "Alveolata", "value": 2}]
+    
+    def test_heatmap_batches_fetch(self, mock_db):
+        """Multi-sample endpoints should fetch uncached jobs in one query"""
+        self._mock_analysis(mock_db, 'job-a', ["Eukaryota;Alveolata;Dinoflagellata"], "a.fasta")
+        mock_db._fetch_analysis('job-a')
+        
+        query = mock_db.client.table.return_value.select.return_value.in_.return_value
+        query.execute.return_value.data = [
+            {'job_id': 'job-c', 'sample_name': 'c.fasta',
+             'taxonomies': ["Eukaryota;Chlorophyta;Chlorophyceae"]},
+            {'job_id': 'job-b', 'sample_name': 'b.fasta',
+             'taxonomies': ["Eukaryota;Alveolata;Dinoflagellata"]},
+        ]
+        
+        heatmap = mock_db.get_heatmap_data(['job-a', 'job-b', 'job-c'], rank="class")
+        
+        mock_db.client.table.return_value.select.return_value.in_.assert_called_once_with(
+            'job_id', ['job-b', 'job-c']
+        )
+        assert heatmap["samples"] == ["a.fasta", "b.fasta", "c.fasta"]
+        assert heatmap["taxa"] == ["Chlorophyceae", "Dinoflagellata"]
+        assert heatmap["matrix"].tolist() == [[0, 1], [0, 1], [1, 0]]
+    
+    def test_async_accessors_skip_sync_redis(self, mock_db):
+        """The blocking Redis client must not be called from the event loop"""
+        mock_db.redis = Mock()
+        
+        def handler(request):
+            return httpx.Response(200, json=[
+                {'job_id': 'job-nr', 'sample_name': None, 'taxonomies': ["Eukaryota; Alveolata"]}
+            ])
+        
+        mock_db._http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://test")
+        
+        asyncio.run(mock_db.get_heatmap_data_async(['job-nr']))
+        asyncio.run(mock_db.get_taxonomic_composition_async('job-nr'))
+        asyncio.run(mock_db.get_chart_json_async('job-nr', "sankey"))
+        
+        assert mock_db.redis.method_calls == []
+        
+        # Sync callers still share results through Redis
+        mock_db._analysis_cache.pop('job-nr')
+        mock_db.redis.get.return_value = None
+        self._mock_analysis(mock_db, 'job-nr', ["Eukaryota"])
+        mock_db._fetch_analysis('job-nr')
+        mock_db.redis.get.assert_called_once()
+        mock_db.redis.setex.assert_called_once()
+    
+    def test_all_visualizations_in_one_request(self, mock_db):
+        """Batch endpoint should read both viz columns and taxon counts in one query"""
+        hierarchy = '{"hierarchy": [{"name": "Eukaryota", "value": 3, "children": []}]}'
+        sankey = '{"nodes": ["Eukaryota"], "links": []}'
+        requests = []
+        
+        def handler(request):
+            requests.append(request.url.params)
+            return httpx.Response(200, json=[{
+                'viz_hierarchy': hierarchy,
+                'viz_sankey': sankey,
+                'taxon_counts': [{'taxon': 'Alveolata', 'count': 2}, {'taxon': 'Metazoa', 'count': 1}]
+            }])
+        
+        mock_db._http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://test")
+        
+        body = json.loads(asyncio.run(mock_db.get_all_visualizations_json_async('job-all', "class")))
+        
+        assert len(requests) == 1
+        assert requests[0]['taxon_counts.rank'] == 'eq.class'
+        assert body["hierarchy"] == json.loads(hierarchy)
+        assert body["sankey"] == json.loads(sankey)
+        assert body["composition"]["total"] == 3
+        assert [taxon["name"] for taxon in body["composition"]["composition"]] == ["Alveolata", "Metazoa"]
+        
+        # Memoized after the first read
+        asyncio.run(mock_db.get_all_visualizations_json_async('job-all', "class"))
+        assert len(requests) == 1
+
+    def test_all_visualizations_without_migrations(self, mock_db):
+        """Missing viz columns / taxon_counts should fall back to the taxonomies, not an empty body"""
+        paths = []
+        
+        def handler(request):
+            paths.append(request.url.path)
+            if request.url.path == '/analysis_taxonomies':
+                return httpx.Response(200, json=[{
+                    'job_id': 'job-old', 'sample_name': None,
+                    'taxonomies': ["Eukaryota; Alveolata", "Eukaryota; Metazoa"]
+                }])
+            return httpx.Response(400, json={"code": "42703", "message": "column does not exist"})
+        
+        mock_db._http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://test")
+        
+        body = json.loads(asyncio.run(mock_db.get_all_visualizations_json_async('job-old')))
+        
+        assert body["composition"]["total"] == 2
+        assert body["hierarchy"]["hierarchy"][0]["name"] == "Eukaryota"
+        assert body["sankey"]["links"]
+        assert paths.count('/analysis_taxonomies') == 1
+    
+    def test_all_visualizations_missing_job_not_memoized(self, mock_db):
+        """An unknown job should return None and be looked up again next time"""
+        requests = []
+        
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json=[])
+        
+        mock_db._http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://test")
+        
+        assert asyncio.run(mock_db.get_all_visualizations_json_async('job-none')) is None
+        asyncio.run(mock_db.get_all_visualizations_json_async('job-none'))
+        assert len(requests) == 2
+    
+    def test_async_heatmap_fetches_batches_concurrently(self, mock_db):
+        """Async heatmap should split uncached ids into concurrent IN queries"""
+        rows = {f'job-{i}': [f"Eukaryota;Alveolata;Taxon{i % 2}"] for i in range(10)}
+        requests = []
+        
+        def handler(request):
+            requests.append(request.url.params['job_id'])
+            # in.("id1","id2") - the quoted values read as a JSON array
+            ids = json.loads('[' + request.url.params['job_id'][len('in.('):-1] + ']')
+            return httpx.Response(200, json=[
+                {'job_id': job_id, 'sample_name': job_id, 'taxonomies': rows[job_id]} for job_id in ids
+            ])
+        
+        mock_db._http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://test")
+        
+        heatmap = asyncio.run(mock_db.get_heatmap_data_async(list(rows), rank="class"))
+        
+        assert len(requests) == 2
+        assert heatmap["samples"] == list(rows)
+        assert heatmap["matrix"].sum() == 10
+        
+        # Second call is served from the analysis cache
+        asyncio.run(mock_db.get_heatmap_data_async(list(rows), rank="class"))
+        assert len(requests) == 2
+
+
+class TestBetaDiversity:
+    """Test the beta diversity ordination"""
+    
+    def test_pcoa_matches_textbook_double_centering(self):
+        """Row/column-mean centering should equal B = -1/2 J D^2 J with J = I - 11'/n"""
+        rng = np.random.default_rng(0)
+        points = rng.random((6, 4))
+        dissim = np.sqrt(((points[:, None] - points[None, :]) ** 2).sum(axis=-1))
+        
+        n = len(dissim)
+        j = np.eye(n) - np.ones((n, n)) / n
+        b = -0.5 * j @ (dissim ** 2) @ j
+        eigvals, eigvecs = np.linalg.eigh(b)
+        order = np.argsort(eigvals)[::-1][:2]
+        expected = eigvecs[:, order] * np.sqrt(eigvals[order])
+        
+        coords = supabase_db._pcoa(dissim)
+        
+        # Eigenvectors are only defined up to sign
+        signs = np.sign((coords * expected).sum(axis=0))
+        np.testing.assert_allclose(coords, expected * signs, atol=1e-10)
+        assert coords.flags['C_CONTIGUOUS']
+    
+    def test_pcoa_pads_small_inputs(self):
+        """Fewer samples than axes should still give n x n_components coordinates"""
+        assert supabase_db._pcoa(np.zeros((1, 1))).shape == (1, 2)
+        assert supabase_db._pcoa(np.array([[0.0, 1.0], [1.0, 0.0]]), n_components=3).shape == (2, 3)
+
+
+class TestJobLoader:
+    """Test collapsing of concurrent job lookups"""
+    
+    def test_concurrent_loads_share_one_fetch(self):
+        """Loads in the same window should cost one batched fetch"""
+        calls = []
+        
+        async def fetch_many(job_ids):
+            calls.append(sorted(job_ids))
+            return {job_id: {'job_id': job_id} for job_id in job_ids if job_id != 'missing'}
+        
+        async def scenario():
+            loader = JobLoader(fetch_many, window=0.001)
+            return await asyncio.gather(
+                loader.load('job-1'), loader.load('job-2'), loader.load('job-1'), loader.load('missing')
+            )
+        
+        results = asyncio.run(scenario())
+        
+        assert calls == [['job-1', 'job-2', 'missing']]
+        assert results == [{'job_id': 'job-1'}, {'job_id': 'job-2'}, {'job_id': 'job-1'}, None]
+    
+    def test_full_batch_dispatches_immediately(self):
+        """Reaching max_batch should not wait for the window"""
+        calls = []
+        
+        async def fetch_many(job_ids):
+            calls.append(len(job_ids))
+            return {}
+        
+        async def scenario():
+            loader = JobLoader(fetch_many, window=10, max_batch=2)
+            return await asyncio.wait_for(
+                asyncio.gather(loader.load('a'), loader.load('b')), timeout=1
+            )
+        
+        assert asyncio.run(scenario()) == [None, None]
+        assert calls == [2]
+    
+    def test_fetch_error_reaches_every_load(self):
+        """A failed batch should raise in each caller instead of looking like missing jobs"""
+        async def fetch_many(job_ids):
+            raise httpx.ConnectError("connection refused")
+        
+        async def scenario():
+            loader = JobLoader(fetch_many, window=0.001)
+            return await asyncio.gather(loader.load('a'), loader.load('b'), return_exceptions=True)
+        
+        assert all(isinstance(result, httpx.ConnectError) for result in asyncio.run(scenario()))
+
+
+@pytest.fixture(scope="module")
+def api():
+    """local_api module connected to a mock Supabase client"""
+    with patch.dict(os.environ, {
+        'SUPABASE_URL': 'https://test.supabase.co',
+        'SUPABASE_KEY': 'test-key'
+    }):
+        os.environ.pop('REDIS_URL', None)
+        with patch('db.supabase_db.create_client'):
+            import local_api
+    return local_api
+
+
+class TestLocalApi:
+    """Test the local visualization API's HTTP behaviour"""
+    
+    @pytest.fixture
+    def client(self, api):
+        """TestClient reporting server errors as responses (lifespan not run)"""
+        from fastapi.testclient import TestClient
+        yield TestClient(api.app, raise_server_exceptions=False)
+        api.db._http = None
+    
+    def _supabase(self, api, handler):
+        """Route the API's PostgREST requests to handler"""
+        api.db._http = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://test")
+    
+    def test_stored_chart_is_immutable_and_revalidates(self, api, client):
+        """Stored chart bodies get an ETag; matching If-None-Match answers 304"""
+        self._supabase(api, lambda request: httpx.Response(
+            200, json=[{"viz_hierarchy": '{"hierarchy":[{"name":"Eukaryota","value":1}]}'}]
+        ))
+        url = "/visualizations/hierarchy/5f0c2a8e-6b1d-4c3e-9a7f-2d4b6c8e0a11"
+        
+        response = client.get(url)
+        etag = response.headers["etag"]
+        
+        assert response.status_code == 200
+        assert "immutable" in response.headers["cache-control"]
+        # Weak - compressed and identity bodies share it
+        assert etag.startswith('W/"')
+        for if_none_match in (etag, etag.removeprefix("W/"), f'"other", {etag}', "*"):
+            revalidated = client.get(url, headers={"If-None-Match": if_none_match})
+            assert revalidated.status_code == 304
+            assert revalidated.content == b""
+        assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+    
+    def test_missing_job_is_not_immutable(self, api, client):
+        """Empty fallbacks for unknown jobs must not be pinned in browser caches"""
+        self._supabase(api, lambda request: httpx.Response(200, json=[]))
+        job_id = "0d6a1f3e-7c2b-4e5d-8f9a-1b3c5d7e9f20"
+        
+        for url, empty in (
+            (f"/visualizations/composition/{job_id}", supabase_db.EMPTY_PAYLOADS["composition"]),
+            (f"/visualizations/sankey/{job_id}", supabase_db.EMPTY_PAYLOADS["sankey"]),
+            (f"/visualizations/all/{job_id}", supabase_db.EMPTY_PAYLOADS),
+        ):
+            response = client.get(url)
+            assert response.status_code == 200
+            assert response.json() == empty
+            assert response.headers["cache-control"] == "no-cache"
+    
+    def test_job_lookup_rejects_malformed_id(self, api, client):
+        """Malformed ids shouldn't reach the batched lookup, and valid ones are sent quoted
+        without pulling the viz_* payloads"""
+        requests = []
+        
+        def handler(request):
+            assert 'viz_' not in request.url.params['select']
+            requests.append(request.url.params['job_id'])
+            return httpx.Response(200, json=[])
+        self._supabase(api, handler)
+        job_id = "7e2d9c4a-1f3b-4a5c-8d6e-0b2a4c6e8f13"
+        
+        assert client.get("/jobs/not-a-uuid").status_code == 422
+        assert requests == []
+        assert client.get(f"/jobs/{job_id}").status_code == 404
+        assert requests == [f'in.("{job_id}")']
+    
+    def _response_cache(self):
+        """Mock async Redis client (and the pipeline it hands out)"""
+        pipe = Mock(execute=AsyncMock())
+        cache = Mock(get=AsyncMock(return_value=None))
+        cache.pipeline.return_value = MagicMock(
+            __aenter__=AsyncMock(return_value=pipe), __aexit__=AsyncMock(return_value=False)
+        )
+        return cache, pipe
+    
+    def test_multi_sample_params_validated_before_cache(self, api, client):
+        """Bad job_ids / rank are rejected without touching Redis or Supabase"""
+        cache, _ = self._response_cache()
+        self._supabase(api, lambda request: pytest.fail("Supabase should not be queried"))
+        ids = [str(uuid.uuid4()) for _ in range(api.MAX_JOB_IDS + 1)]
+        
+        with patch.object(api, 'response_cache', cache):
+            for url, status in (
+                (f"/visualizations/heatmap?job_ids={','.join(ids)}", 400),
+                (f"/visualizations/diversity?job_ids={ids[0]},,{ids[1]}", 400),
+                (f"/visualizations/diversity?job_ids={ids[0]},not-a-uuid", 400),
+                (f"/visualizations/heatmap?job_ids={ids[0]}&rank=kingdom", 422),
+                (f"/visualizations/composition/{ids[0]}?rank=kingdom", 422),
+            ):
+                assert client.get(url).status_code == status, url
+        
+        cache.get.assert_not_called()
+    
+    def test_only_complete_results_are_cached(self, api, client):
+        """Heatmaps missing a requested job must not be pinned in Redis"""
+        stored, missing = str(uuid.uuid4()), str(uuid.uuid4())
+        cache, pipe = self._response_cache()
+        self._supabase(api, lambda request: httpx.Response(200, json=[
+            {'job_id': stored, 'sample_name': 'stored', 'taxonomies': ["Eukaryota; Alveolata; Ciliophora"]}
+        ]))
+        
+        with patch.object(api, 'response_cache', cache):
+            partial = client.get(f"/visualizations/heatmap?job_ids={stored},{missing}")
+            pipe.set.assert_not_called()
+            
+            complete = client.get(f"/visualizations/heatmap?job_ids={stored}")
+            pipe.set.assert_called_once()
+        
+        key = pipe.set.call_args.args[0]
+        assert partial.json()["job_ids"] == [stored]
+        assert complete.json()["matrix"] == [[1]]
+        assert pipe.set.call_args.args[1] == complete.content
+        # Indexed under the job so invalidating it also drops this response
+        pipe.sadd.assert_called_once_with(f"{api.RESPONSE_INDEX_PREFIX}{stored}", key)
+    
+    def test_invalidate_requires_token_and_clears_responses(self, api, client):
+        """Cache invalidation fails closed and drops the job's cached responses"""
+        job_id = str(uuid.uuid4())
+        url = f"/cache/invalidate/{job_id}"
+        cache, _ = self._response_cache()
+        cache.smembers = AsyncMock(return_value={b"taxa:heatmap:class:abc", b"taxa:diversity::def"})
+        cache.delete = AsyncMock()
+        
+        with patch.object(api, 'response_cache', cache), patch.object(api.db, 'invalidate_job') as invalidate:
+            with patch.object(api, 'CACHE_ADMIN_TOKEN', None):
+                assert client.post(url, headers={"X-Admin-Token": ""}).status_code == 403
+            with patch.object(api, 'CACHE_ADMIN_TOKEN', "secret"):
+                assert client.post(url).status_code == 403
+                assert client.post(url, headers={"X-Admin-Token": "wrong"}).status_code == 403
+                invalidate.assert_not_called()
+                
+                response = client.post(url, headers={"X-Admin-Token": "secret"})
+        
+        assert response.json()["responses"] == 2
+        invalidate.assert_called_once_with(job_id)
+        index, *keys = cache.delete.call_args.args
+        assert index == f"{api.RESPONSE_INDEX_PREFIX}{job_id}"
+        assert set(keys) == {b"taxa:heatmap:class:abc", b"taxa:diversity::def"}
+    
+    def test_cors_allows_only_listed_frontends(self, api, client):
+        """Preflights succeed (and are cached) for FRONTEND_URL origins only, GET only"""
+        origin = api.FRONTEND_URLS[0]
+        preflight = {"Access-Control-Request-Method": "GET"}
+        
+        allowed = client.options("/jobs", headers={"Origin": origin, **preflight})
+        other = client.options("/jobs", headers={"Origin": "https://evil.example", **preflight})
+        post = client.options("/jobs", headers={"Origin": origin, "Access-Control-Request-Method": "POST"})
+        
+        assert allowed.status_code == 200
+        assert allowed.headers["access-control-allow-origin"] == origin
+        assert allowed.headers["access-control-max-age"] == "86400"
+        assert other.status_code == 400
+        assert "access-control-allow-origin" not in other.headers
+        assert post.status_code == 400
+    
+    def test_supabase_error_is_bad_gateway(self, api, client):
+        """Failed PostgREST requests should surface as 502, not empty charts"""
+        self._supabase(api, lambda request: httpx.Response(503, json={"message": "unavailable"}))
+        
+        response = client.get("/visualizations/hierarchy/1b4e28ba-2fa1-11d2-883f-0016d3cca427")
+        
+        assert response.status_code == 502
+        assert "cache-control" not in response.headers
+    
+    def test_supabase_unreachable_is_bad_gateway(self, api, client):
+        """Transport failures should also surface as 502"""
+        def handler(request):
+            raise httpx.ConnectError("connection refused", request=request)
+        self._supabase(api, handler)
+        
+        assert client.get("/jobs").status_code == 502
+    
+    def test_unhandled_error_keeps_cors_headers(self, api, client):
+        """500s are built outside CORSMiddleware but must stay readable by the frontend"""
+        origin = api.FRONTEND_URLS[0]
+        
+        with patch.object(api.db, 'get_all_jobs_async', side_effect=RuntimeError("secret")):
+            response = client.get("/jobs", headers={"Origin": origin})
+            other = client.get("/jobs", headers={"Origin": "https://evil.example"})
+        
+        assert response.status_code == 500
+        assert response.json() == {"detail": "Internal server error"}
+        assert response.headers["access-control-allow-origin"] == origin
+        assert "access-control-allow-origin" not in other.headers
+
+
+@pytest.fixture(scope="module")
+def backend():
+    """main_with_db module without a database connection"""
+    with patch.dict(os.environ):
+        os.environ.pop('SUPABASE_KEY', None)
+        import main_with_db
+    return main_with_db
+
+
+class TestStreamJson:
+    """Test the analysis backend's streamed JSON encoding"""
+    
+    def test_stream_json_nested_arrays(self, backend):
+        """Batched and row-wise encoding should still produce one valid JSON document"""
+        payload = {
+            "matrix": np.arange(6, dtype=np.int32).reshape(2, 3),
+            "ragged": [[1, 2], [3], []],
+            "nested": {"rows": [np.array([1.5, 2.5]), np.array([3.5])], "empty": []},
+            "vector": np.arange(5),
+            "records": [{"accession": f"SEQ_{i}", "confidence": np.float64(0.5)}
+                        for i in range(backend.STREAM_BATCH_SIZE * 3 + 7)],
+            "scalar": None
+        }
+        
+        async def collect(response):
+            return [chunk async for chunk in response.body_iterator]
+        
+        chunks = asyncio.run(collect(backend.stream_json(payload)))
+        
+        assert len(chunks) > 1
+        assert json.loads(b"".join(chunks)) == json.loads(
+            backend.orjson.dumps(payload, option=backend.orjson.OPT_SERIALIZE_NUMPY)
+        )
+
+
+class TestBackendApi:
+    """Test the analysis backend's database endpoints"""
+    
+    @pytest.fixture
+    def client(self, backend):
+        """TestClient reporting server errors as responses (lifespan not run)"""
+        from fastapi.testclient import TestClient
+        yield TestClient(backend.app, raise_server_exceptions=False)
+    
+    def test_supabase_errors_are_bad_gateway(self, backend, client):
+        """Failed or unreachable Supabase queries should answer 502, not an empty payload"""
+        from postgrest.exceptions import APIError
+        db = Mock()
+        db.get_job_by_id.side_effect = APIError({'message': 'permission denied', 'code': '42501'})
+        db.get_sankey_data.side_effect = httpx.ConnectError("connection refused")
+        
+        with patch.object(backend, 'db', db):
+            job = client.get("/jobs/7e2d9c4a-1f3b-4a5c-8d6e-0b2a4c6e8f13")
+            sankey = client.get("/visualizations/sankey/7e2d9c4a-1f3b-4a5c-8d6e-0b2a4c6e8f13")
+        
+        assert (job.status_code, job.json()) == (502, {"detail": "permission denied"})
+        assert sankey.status_code == 502
+    
+    def test_multi_sample_job_ids_validated(self, backend, client):
+        """job_ids should be capped and checked before reaching Supabase"""
+        from db.request_params import MAX_JOB_IDS
+        db = Mock()
+        db.calculate_beta_diversity.return_value = {"diversity_matrix": []}
+        ids = [str(uuid.uuid4()) for _ in range(MAX_JOB_IDS + 1)]
+        
+        with patch.object(backend, 'db', db):
+            assert client.get("/visualizations/heatmap", params={"job_ids": ",".join(ids)}).status_code == 400
+            assert client.get("/visualizations/heatmap", params={"job_ids": "a,b"}).status_code == 400
+            assert db.get_heatmap_data.call_count == 0
+            
+            response = client.get("/visualizations/diversity", params={"job_ids": ids[0].upper()})
+        
+        assert response.status_code == 200
+        db.calculate_beta_diversity.assert_called_once_with([ids[0]])
+
+
+class TestTempFilePool:
+    """Test reuse of upload temp files"""
+    
+    def test_released_file_is_reused_empty(self, tmp_path):
+        """A released file should come back truncated and rewound"""
+        from temp_file_pool import TempFilePool
+        pool = TempFilePool(str(tmp_path), size=1)
+        
+        fd, path = pool.acquire()
+        os.write(fd, b">seq1\nATCGATCG\n")
+        pool.release(fd, path)
+        
+        assert pool.acquire() == (fd, path)
+        assert os.fstat(fd).st_size == 0
+        assert os.lseek(fd, 0, os.SEEK_CUR) == 0
+        pool.release(fd, path)
+        pool.close()
+    
+    def test_full_pool_deletes_extra_files(self, tmp_path):
+        """Files beyond the pool size, and all pooled files on close, are deleted"""
+        from temp_file_pool import TempFilePool
+        pool = TempFilePool(str(tmp_path), size=1)
+        
+        first, second = pool.acquire(), pool.acquire()
+        assert first[1] != second[1]
+        pool.release(*first)
+        pool.release(*second)
+        
+        assert not os.path.exists(second[1])
+        assert os.path.exists(first[1])
+        
+        pool.close()
+        assert list(tmp_path.iterdir()) == []
+
+
 class TestIntegrationScenarios:
     """Test complete caching scenarios"""
     
@@ -0,0 +1,89 @@
+"""
+Backfill precomputed chart payloads (viz_hierarchy, viz_sankey) for jobs
+stored before migration__add_viz_columns.sql
+
+Run from the project root: python db/backfill_viz.py
+"""
+import os
+import sys
+from typing import List, Tuple
+
+# Add parent directory to path for db imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.supabase_db import TaxaformerDB, _build_hierarchy, _build_sankey
+
+# Jobs fetched per page
+BATCH_SIZE = 50
+
+
+def backfill(db: TaxaformerDB) -> Tuple[int, List[str]]:
+    """
+    Compute and store chart payloads for every job that lacks them
+    
+    Jobs without sequence taxonomies are skipped (not stored as empty
+    charts) and reported. A failed Supabase read raises, aborting the run.
+    
+    Args:
+        db: Connected database wrapper
+        
+    Returns:
+        Number of jobs updated, and the ids of the jobs skipped
+    """
+    updated = 0
+    skipped = []
+    last_id = None
+    
+    while True:
+        # Updated rows drop out of the filter; paging by id steps past skipped ones
+        query = (db.client.table('analysis_jobs')
+                 .select('job_id')
+                 .is_('viz_hierarchy', 'null')
+                 .not_.is_('result', 'null'))
+        if last_id is not None:
+            query = query.gt('job_id', last_id)
+        pending = query.order('job_id').limit(BATCH_SIZE).execute().data or []
+        
+        if not pending:
+            return updated, skipped
+        
+        job_ids = [row['job_id'] for row in pending]
+        last_id = job_ids[-1]
+        
+        # Read directly: db._fetch_analyses returns nothing on error, which
+        # would store empty charts for the whole page
+        rows = (db.client.table('analysis_taxonomies')
+                .select('job_id, taxonomies')
+                .in_('job_id', job_ids)
+                .execute()).data or []
+        analyses = {row['job_id']: row for row in rows}
+        
+        for job_id in job_ids:
+            analysis = analyses.get(job_id)
+            if analysis is None:
+                skipped.append(job_id)
+                continue
+            
+            taxonomies = analysis.get('taxonomies') or []
+            db.client.table('analysis_jobs').update({
+                "viz_hierarchy": _build_hierarchy(taxonomies),
+                "viz_sankey": _build_sankey(taxonomies)
+            }).eq('job_id', job_id).execute()
+            updated += 1
+        
+        print(f"✅ Backfilled {updated} jobs ({len(skipped)} skipped)")
+
+
+if __name__ == "__main__":
+    print("🔄 Backfilling visualization data...")
+    try:
+        total, skipped = backfill(TaxaformerDB())
+    except Exception as e:
+        print(f"❌ Backfill aborted: {e}")
+        sys.exit(1)
+    
+    print(f"🎉 Done - {total} jobs updated")
+    if skipped:
+        print(f"⚠️  Skipped {len(skipped)} jobs with no sequence taxonomies:")
+        for job_id in skipped:
+            print(f"   - {job_id}")
@@ -0,0 +1,78 @@
+"""
+Job Loader for TaxaFormer
+Collapses concurrent single-job lookups into one batched query
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+
+class JobLoader:
+    """
+    DataLoader-style request collapser
+    
+    Ids requested within `window` seconds of each other are fetched with a
+    single call to `fetch_many`; concurrent requests for the same id share
+    one result. Create one per event loop (i.e. per server worker).
+    """
+    
+    def __init__(self, fetch_many: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+                 window: float = 0.005, max_batch: int = 50):
+        self._fetch_many = fetch_many
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+    
+    async def load(self, job_id: str) -> Optional[Any]:
+        """
+        Get one record, batched with other loads in the same window
+        
+        Args:
+            job_id: Job UUID
+            
+        Returns:
+            The record, or None if it doesn't exist
+        """
+        future = self._pending.get(job_id)
+        
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[job_id] = future
+            
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = asyncio.create_task(self._flush_after_window())
+        
+        # Shielded so one cancelled request doesn't cancel the shared result
+        return await asyncio.shield(future)
+    
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self._dispatch()
+    
+    def _dispatch(self):
+        """Start fetching everything collected so far"""
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        
+        # Keep a reference so the task isn't garbage collected mid-flight
+        task = asyncio.create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+    
+    async def _run(self, batch: Dict[str, asyncio.Future]):
+        try:
+            records = await self._fetch_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for job_id, future in batch.items():
+            if not future.done():
+                future.set_result(records.get(job_id))
@@ -0,0 +1,19 @@
+-- Database migration: Taxonomy projection for visualization endpoints
+-- Run this once in Supabase SQL Editor (after migration__add_analysis_jobs.sql)
+
+-- Visualization endpoints only need the taxonomy string of each sequence.
+-- Reading them through this view keeps the rest of the result JSON
+-- (per-sequence scores, cluster data, summaries) off the wire.
+CREATE OR REPLACE VIEW analysis_taxonomies AS
+SELECT
+    job_id,
+    COALESCE(result->'metadata'->>'sampleName', filename) AS sample_name,
+    ARRAY(
+        SELECT seq->>'taxonomy'
+        FROM jsonb_array_elements(COALESCE(result->'sequences', '[]'::jsonb)) AS seq
+    ) AS taxonomies
+FROM analysis_jobs
+WHERE result IS NOT NULL;
+
+-- Grant read access to the API roles (adjust as needed for your Supabase setup)
+GRANT SELECT ON analysis_taxonomies TO anon, authenticated;
@@ -0,0 +1,60 @@
+-- Database migration: Precomputed taxonomic composition per job and rank
+-- Run this once in Supabase SQL Editor (after migration__add_analysis_jobs.sql)
+
+-- One row per (job, rank, taxon). Filled by a trigger whenever a job's
+-- result is written, so the composition endpoint is a point lookup
+-- instead of re-counting every sequence on each request.
+CREATE TABLE IF NOT EXISTS taxon_counts (
+    job_id UUID NOT NULL REFERENCES analysis_jobs(job_id) ON DELETE CASCADE,
+    rank TEXT NOT NULL,
+    taxon TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    first_seen INTEGER NOT NULL,
+    PRIMARY KEY (job_id, rank, taxon)
+);
+
+-- Ordered reads: most common first, ties in order of first appearance
+CREATE INDEX IF NOT EXISTS idx_taxon_counts_lookup
+    ON taxon_counts(job_id, rank, count DESC, first_seen);
+
+-- Taxon names follow the same rules as the API: split on ';', trim,
+-- and report missing or empty levels as 'Unknown'.
+CREATE OR REPLACE FUNCTION refresh_taxon_counts()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM taxon_counts WHERE job_id = NEW.job_id;
+
+    INSERT INTO taxon_counts (job_id, rank, taxon, count, first_seen)
+    SELECT NEW.job_id, r.rank, t.taxon, COUNT(*), MIN(t.ord)
+    FROM (VALUES
+        ('domain', 1), ('phylum', 2), ('class', 3), ('order', 4),
+        ('family', 5), ('genus', 6), ('species', 7)
+    ) AS r(rank, pos)
+    CROSS JOIN LATERAL (
+        SELECT
+            COALESCE(
+                NULLIF(btrim(split_part(COALESCE(seq->>'taxonomy', ''), ';', r.pos)), ''),
+                'Unknown'
+            ) AS taxon,
+            s.ord
+        FROM jsonb_array_elements(COALESCE(NEW.result->'sequences', '[]'::jsonb))
+             WITH ORDINALITY AS s(seq, ord)
+    ) AS t
+    GROUP BY r.rank, t.taxon;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS analysis_jobs_taxon_counts ON analysis_jobs;
+CREATE TRIGGER analysis_jobs_taxon_counts
+    AFTER INSERT OR UPDATE OF result ON analysis_jobs
+    FOR EACH ROW
+    WHEN (NEW.result IS NOT NULL)
+    EXECUTE FUNCTION refresh_taxon_counts();
+
+-- Backfill existing jobs (re-fires the trigger for each row)
+UPDATE analysis_jobs SET result = result WHERE result IS NOT NULL;
+
+-- Grant read access to the API roles (adjust as needed for your Supabase setup)
+GRANT SELECT ON taxon_counts TO anon, authenticated;
@@ -0,0 +1,10 @@
+-- Database migration: Precomputed chart payloads per job
+-- Run this once in Supabase SQL Editor (after migration__add_analysis_jobs.sql)
+
+-- Hierarchy (Krona/Sunburst) and Sankey payloads are computed once when a
+-- job is stored, so the read endpoints return them without re-aggregating.
+-- Composition per rank is served from taxon_counts (migration__add_taxon_counts.sql).
+ALTER TABLE analysis_jobs ADD COLUMN IF NOT EXISTS viz_hierarchy jsonb;
+ALTER TABLE analysis_jobs ADD COLUMN IF NOT EXISTS viz_sankey jsonb;
+
+-- Existing jobs: run `python db/backfill_viz.py` to fill these columns
@@ -0,0 +1,31 @@
+"""
+Request Parameters for TaxaFormer
+Query parameter dependencies shared by the API apps
+"""
+import uuid
+from typing import List
+
+from fastapi import HTTPException, Query
+
+# Most samples one multi-sample request may compare (bounds the Supabase query)
+MAX_JOB_IDS = 50
+
+# Room for MAX_JOB_IDS UUIDs and separators
+JobIds = Query(..., max_length=MAX_JOB_IDS * 40)
+
+
+def job_id_list(job_ids: str = JobIds) -> List[str]:
+    """
+    Dependency splitting the comma-separated job_ids parameter
+    
+    Runs before the endpoint (and any response cache), rejecting more than
+    MAX_JOB_IDS ids and empty or malformed ones. Ids come back in canonical
+    UUID form, so equivalent requests share a cache key.
+    """
+    ids = job_ids.split(",")
+    if len(ids) > MAX_JOB_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_JOB_IDS} job_ids per request")
+    try:
+        return [str(uuid.UUID(job_id.strip())) for job_id in ids]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="job_ids must be comma-separated UUIDs")
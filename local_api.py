@@ -4,30 +4,256 @@ Runs locally, fetches from Supabase, formats for charts
 Kaggle backend stores data → This serves visualization endpoints
 """
 
-from fastapi import FastAPI, HTTPException
+import os
+import hmac
+import asyncio
+import uuid
+import hashlib
+import logging
+import functools
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+import orjson
+import httpx
+from fastapi import FastAPI, HTTPException, Header, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 import uvicorn
-from db.supabase_db import TaxaformerDB
+from db.supabase_db import TaxaformerDB, EMPTY_PAYLOADS
+from db.job_loader import JobLoader
+from db.request_params import MAX_JOB_IDS, job_id_list
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# Optional: brotli compresses chart JSON better than gzip at similar CPU
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(levelname)s %(name)s: %(message)s")
+# httpx logs every request at INFO - keep per-request lines off the hot path
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Multi-sample responses are cached in Redis (optional - set REDIS_URL);
+# each job's index set lists the cached responses that include it
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_INDEX_PREFIX = "taxa:responses:"
+response_cache = (
+    aioredis.Redis.from_url(os.environ["REDIS_URL"])
+    if aioredis is not None and os.getenv("REDIS_URL") else None
+)
+
+# Browser/CDN caching of per-job responses (stored jobs don't change)
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "3600"))
+
+# Bodies larger than this are streamed in STREAM_CHUNK_SIZE slices
+STREAM_THRESHOLD = 1 << 20
+STREAM_CHUNK_SIZE = 64 << 10
+
+Rank = Literal["domain", "phylum", "class", "order", "family", "genus", "species"]
+
+# Responses smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+# Shared secret for cache admin endpoints (X-Admin-Token header); the
+# endpoints are disabled when it isn't set
+CACHE_ADMIN_TOKEN = os.getenv("CACHE_ADMIN_TOKEN")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm the Supabase connection pool before serving and close it on shutdown"""
+    await db.connect()
+    yield
+    await db.aclose()
 
 # Initialize
 app = FastAPI(
     title="Taxaformer Local Visualization API",
     description="Fetches data from Supabase and formats for charts",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# CORS
+# CORS - explicit frontend origins (comma-separated FRONTEND_URL); read-only,
+# so browsers only need GET. Preflights are cached for a day.
+FRONTEND_URLS = [
+    origin.strip() for origin in os.getenv("FRONTEND_URL", "http://localhost:3000").split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=FRONTEND_URLS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET"],
+    allow_headers=["authorization", "content-type"],
+    max_age=86400,
 )
 
+# Compress large JSON bodies (brotli when installed, gzip otherwise)
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, quality=4, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=5)
+
+
+def cors_headers(request: Request) -> dict:
+    """CORS headers for responses built outside CORSMiddleware"""
+    origin = request.headers.get("origin")
+    if origin not in FRONTEND_URLS:
+        return {}
+    return {"Access-Control-Allow-Origin": origin, "Access-Control-Allow-Credentials": "true", "Vary": "Origin"}
+
+
+# Errors escaping an endpoint: failed Supabase requests are upstream (502),
+# anything else is a 500
+@app.exception_handler(httpx.HTTPStatusError)
+@app.exception_handler(httpx.TransportError)
+async def supabase_error_handler(request: Request, exc: httpx.HTTPError):
+    """Report a failed or unreachable PostgREST request as a bad gateway"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        logger.warning("Supabase error on %s: %s %s", request.url.path,
+                       exc.response.status_code, exc.response.text)
+    else:
+        logger.warning("Supabase unreachable on %s: %r", request.url.path, exc)
+    return ORJSONResponse({"detail": "Database request failed"}, status_code=502)
+
+
+@app.exception_handler(Exception)
+async def unhandled_error_handler(request: Request, exc: Exception):
+    """
+    Generic fallback - don't leak internals in the response
+    
+    Starlette runs this handler outside CORSMiddleware, so the CORS headers
+    are added here or browsers would hide the 500 from the frontend.
+    """
+    logger.error("Unhandled error on %s %s: %r", request.method, request.url.path, exc)
+    return ORJSONResponse({"detail": "Internal server error"}, status_code=500, headers=cors_headers(request))
+
+
 # Database connection
 db = TaxaformerDB()
 
+# Concurrent /jobs/{job_id} lookups are collapsed into one query per 5 ms window
+job_loader = JobLoader(db.get_jobs_by_ids_async, window=0.005)
+
+
+def get_job_loader() -> JobLoader:
+    """Dependency providing the shared job loader"""
+    return job_loader
+
+
+def cached_response(prefix: str, ttl: int = RESPONSE_CACHE_TTL):
+    """
+    Cache a multi-sample endpoint's JSON body in Redis
+    
+    Stored jobs are immutable, so the same job_ids and rank always produce
+    the same body. Keys keep the requested id order because it sets the
+    order of the samples in the response. The endpoint takes job_ids from
+    job_id_list, so invalid requests are rejected before the cache lookup.
+    
+    The endpoint returns its payload, which must list the jobs it found in
+    "job_ids". Only complete results are cached - a missing job may just
+    not be stored yet - and errors raise past the cache.
+    
+    Args:
+        prefix: Key namespace for the endpoint
+        ttl: Seconds to keep a cached body
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(**kwargs):
+            if response_cache is None:
+                return ORJSONResponse(await handler(**kwargs))
+            
+            digest = hashlib.sha1(",".join(kwargs["job_ids"]).encode()).hexdigest()
+            key = f"taxa:{prefix}:{kwargs.get('rank', '')}:{digest}"
+            
+            try:
+                body = await response_cache.get(key)
+                if body is not None:
+                    return Response(content=body, media_type="application/json")
+            except Exception as e:
+                logger.warning("Redis get failed: %s", e)
+            
+            result = await handler(**kwargs)
+            response = ORJSONResponse(result)
+            
+            if set(result["job_ids"]) == set(kwargs["job_ids"]):
+                try:
+                    async with response_cache.pipeline(transaction=False) as pipe:
+                        pipe.set(key, response.body, ex=ttl)
+                        for job_id in set(kwargs["job_ids"]):
+                            pipe.sadd(f"{RESPONSE_INDEX_PREFIX}{job_id}", key)
+                            pipe.expire(f"{RESPONSE_INDEX_PREFIX}{job_id}", ttl)
+                        await pipe.execute()
+                except Exception as e:
+                    logger.warning("Redis set failed: %s", e)
+            
+            return response
+        return wrapper
+    return decorator
+
+
+class ConditionalResponse:
+    """
+    Dependency that sends JSON bodies with a content ETag and Cache-Control,
+    answering a matching If-None-Match with 304 Not Modified
+    
+    The ETag is weak: the compression middleware sends gzip/brotli and
+    identity bodies under the same tag, which are only semantically equal.
+    """
+    
+    def __init__(self, request: Request):
+        self.if_none_match = request.headers.get("if-none-match")
+    
+    def __call__(self, body: bytes, immutable: bool = True) -> Response:
+        """
+        Args:
+            body: Encoded JSON response body
+            immutable: Whether clients may reuse the body without revalidating
+                (only for bodies read from a stored job, never for fallbacks)
+        """
+        opaque = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        etag = f"W/{opaque}"
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"public, max-age={HTTP_CACHE_MAX_AGE}, immutable" if immutable else "no-cache"
+        }
+        
+        if self.if_none_match and (
+            self.if_none_match.strip() == "*"
+            or opaque in (tag.strip().removeprefix("W/") for tag in self.if_none_match.split(","))
+        ):
+            return Response(status_code=304, headers=headers)
+        
+        if len(body) > STREAM_THRESHOLD:
+            # Large trees go out in slices so the client can start parsing early
+            # (memoryview slices don't copy the body)
+            view = memoryview(body)
+            chunks = (view[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(view), STREAM_CHUNK_SIZE))
+            headers["Content-Length"] = str(len(body))
+            return StreamingResponse(chunks, media_type="application/json", headers=headers)
+        
+        return Response(content=body, media_type="application/json", headers=headers)
+
+
+def respond_stored(respond: ConditionalResponse, body: Optional[bytes], empty: dict) -> Response:
+    """
+    Send a body read from a stored job, or the empty payload if the job
+    doesn't exist (yet) - that one is revalidated so it isn't pinned in caches
+    """
+    if body is None:
+        return respond(orjson.dumps(empty), immutable=False)
+    return respond(body)
+
 
 @app.get("/")
 async def root():
@@ -46,66 +272,64 @@ async def root():
 # ================================
 
 @app.get("/visualizations/composition/{job_id}")
-async def get_composition(job_id: str, rank: str = "phylum"):
+async def get_composition(job_id: uuid.UUID, rank: Rank = "phylum", respond: ConditionalResponse = Depends()):
     """
     Get taxonomic composition for pie/bar charts
     
     Query params:
         rank: domain, phylum, class, order, family, genus, species
     """
-    try:
-        return db.get_taxonomic_composition(job_id, rank)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    composition = await db.get_taxonomic_composition_async(str(job_id), rank)
+    body = orjson.dumps(composition) if composition is not None else None
+    return respond_stored(respond, body, EMPTY_PAYLOADS["composition"])
 
 
 @app.get("/visualizations/hierarchy/{job_id}")
-async def get_hierarchy(job_id: str):
+async def get_hierarchy(job_id: uuid.UUID, respond: ConditionalResponse = Depends()):
     """Get hierarchical data for Krona/Sunburst plot"""
-    try:
-        return db.get_hierarchical_data(job_id)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return respond_stored(respond, await db.get_chart_json_async(str(job_id), "hierarchy"), EMPTY_PAYLOADS["hierarchy"])
 
 
 @app.get("/visualizations/sankey/{job_id}")
-async def get_sankey(job_id: str):
+async def get_sankey(job_id: uuid.UUID, respond: ConditionalResponse = Depends()):
     """Get Sankey/Ribbon flow diagram data"""
-    try:
-        return db.get_sankey_data(job_id)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return respond_stored(respond, await db.get_chart_json_async(str(job_id), "sankey"), EMPTY_PAYLOADS["sankey"])
+
+
+@app.get("/visualizations/all/{job_id}")
+async def get_all_visualizations(job_id: uuid.UUID, rank: Rank = "phylum", respond: ConditionalResponse = Depends()):
+    """
+    Get composition, hierarchy and sankey data in one response
+    
+    Query params:
+        rank: Taxonomic rank for the composition
+    """
+    return respond_stored(respond, await db.get_all_visualizations_json_async(str(job_id), rank), EMPTY_PAYLOADS)
 
 
 @app.get("/visualizations/heatmap")
-async def get_heatmap(job_ids: str, rank: str = "class"):
+@cached_response("heatmap")
+async def get_heatmap(job_ids: List[str] = Depends(job_id_list), rank: Rank = "class"):
     """
     Get heatmap data for multiple samples
     
     Query params:
-        job_ids: Comma-separated job IDs (e.g., "id1,id2,id3")
+        job_ids: Comma-separated job IDs (e.g., "id1,id2,id3"), at most MAX_JOB_IDS
         rank: Taxonomic rank to compare
     """
-    try:
-        ids = job_ids.split(",")
-        return db.get_heatmap_data(ids, rank)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return await db.get_heatmap_data_async(job_ids, rank)
 
 
 @app.get("/visualizations/diversity")
-async def get_diversity(job_ids: str):
+@cached_response("diversity")
+async def get_diversity(job_ids: List[str] = Depends(job_id_list)):
     """
     Calculate beta diversity between samples
     
     Query params:
-        job_ids: Comma-separated job IDs
+        job_ids: Comma-separated job IDs, at most MAX_JOB_IDS
     """
-    try:
-        ids = job_ids.split(",")
-        return db.calculate_beta_diversity(ids)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return await db.calculate_beta_diversity_async(job_ids)
 
 
 # ================================
@@ -115,24 +339,59 @@ async def get_diversity(job_ids: str):
 @app.get("/jobs")
 async def list_jobs(limit: int = 50):
     """List all analysis jobs from database"""
-    try:
-        return db.get_all_jobs(limit)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return await db.get_all_jobs_async(limit)
 
 
 @app.get("/jobs/{job_id}")
-async def get_job(job_id: str):
-    """Get specific job data by ID"""
-    try:
-        job = db.get_job_by_id(job_id)
-        if job is None:
-            raise HTTPException(status_code=404, detail="Job not found")
-        return job
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_job(job_id: uuid.UUID, respond: ConditionalResponse = Depends(),
+                  loader: JobLoader = Depends(get_job_loader)):
+    """
+    Get specific job data by ID
+    
+    Malformed ids are rejected (422) before they reach the loader, where
+    they would make PostgREST fail the whole batch they share.
+    """
+    job = await loader.load(str(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Only finished jobs are immutable
+    return respond(orjson.dumps(job), immutable=job.get("status") == "complete")
+
+
+# ================================
+# CACHE ENDPOINTS
+# ================================
+
+@app.post("/cache/invalidate/{job_id}")
+async def invalidate_job_cache(job_id: uuid.UUID, x_admin_token: str = Header(None)):
+    """
+    Drop cached data for a job after it is written or updated
+    
+    Called by the writer (Kaggle backend) when a job completes. Clears this
+    worker's in-process caches, the shared Redis analysis cache and every
+    cached multi-sample response that includes the job. Other workers'
+    in-process copies still expire on their own (within ANALYSIS_CACHE_TTL
+    + VIZ_CACHE_TTL), and bodies already sent as immutable stay in browser
+    and CDN caches for up to HTTP_CACHE_MAX_AGE.
+    """
+    if not CACHE_ADMIN_TOKEN or not hmac.compare_digest((x_admin_token or "").encode(), CACHE_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    
+    job_id = str(job_id)
+    # Runs the sync Redis client, so keep it off the event loop
+    await asyncio.to_thread(db.invalidate_job, job_id)
+    
+    responses = 0
+    if response_cache is not None:
+        index = f"{RESPONSE_INDEX_PREFIX}{job_id}"
+        try:
+            keys = await response_cache.smembers(index)
+            await response_cache.delete(index, *keys)
+            responses = len(keys)
+        except Exception as e:
+            logger.warning("Redis delete failed: %s", e)
+    
+    return {"status": "invalidated", "job_id": job_id, "responses": responses}
 
 
 # ================================
@@ -153,8 +412,23 @@ if __name__ == "__main__":
     print("  GET /visualizations/composition/{job_id}?rank=phylum")
     print("  GET /visualizations/hierarchy/{job_id}")
     print("  GET /visualizations/sankey/{job_id}")
+    print("  GET /visualizations/all/{job_id}?rank=phylum")
     print("  GET /visualizations/heatmap?job_ids=id1,id2&rank=class")
     print("  GET /visualizations/diversity?job_ids=id1,id2,id3")
+    print("  POST /cache/invalidate/{job_id}     - Drop cached job data")
     print("\n" + "="*70 + "\n")
     
-    uvicorn.run(app, host="0.0.0.0", port=3001)
+    # Each worker keeps its own connection pool and caches (see WEB_CONCURRENCY
+    # in db/supabase_db.py); multiple workers need the app as an import string
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    
+    uvicorn.run(
+        "local_api:app",
+        host="0.0.0.0",
+        port=3001,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )